@@ -1,5 +1,78 @@
+import functools
+import os
+import warnings
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _compile(fn):
+    """torch.compile ``fn`` when possible, otherwise run it eagerly.
+
+    torch.compile only exists from PyTorch 2.0 on and can fail at decoration
+    time (e.g. torch 2.0/2.1 on Python 3.12). A backend failure on the first
+    call (e.g. CPU Inductor without a C++ toolchain) switches ``fn`` to eager;
+    any other error is raised as is. Set ZS3_DISABLE_COMPILE=1 to always run
+    eagerly.
+    """
+    if os.environ.get("ZS3_DISABLE_COMPILE", "0") != "0" or not hasattr(
+        torch, "compile"
+    ):
+        return fn
+    try:
+        from torch._dynamo.exc import BackendCompilerFailed
+
+        compiled = torch.compile(fn, dynamic=True)
+    except Exception as e:
+        warnings.warn(
+            f"torch.compile unavailable ({e}), running {fn.__name__} eagerly",
+            stacklevel=2,
+        )
+        return fn
+
+    impl = [compiled]
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if impl[0] is fn:
+            return fn(*args, **kwargs)
+        try:
+            return impl[0](*args, **kwargs)
+        except BackendCompilerFailed as e:
+            warnings.warn(
+                f"torch.compile failed ({e}), running {fn.__name__} eagerly",
+                stacklevel=2,
+            )
+            impl[0] = fn
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+@_compile
+def _focal_core(logit, target, ignore_index, gamma, alpha):
+    """Per-pixel focal loss from raw logits, zero on ignored pixels."""
+    logp = F.log_softmax(logit, dim=1)
+    valid = target != ignore_index
+    # ignored pixels are remapped to class 0 so that gather stays in range
+    safe_target = target.masked_fill(~valid, 0)
+    logpt = logp.gather(1, safe_target.unsqueeze(1)).squeeze(1)
+    pt = logpt.exp()
+    loss = -((1 - pt) ** gamma) * logpt
+    if alpha is not None:
+        loss = alpha * loss
+    return loss.masked_fill(~valid, 0)
+
+
+@_compile
+def _ce_core(logit, target, ignore_index):
+    """Per-pixel cross-entropy from raw logits, zero on ignored pixels."""
+    valid = target != ignore_index
+    safe_target = target.masked_fill(~valid, 0)
+    lse = torch.logsumexp(logit, dim=1)
+    gathered = logit.gather(1, safe_target.unsqueeze(1)).squeeze(1)
+    return (lse - gathered).masked_fill(~valid, 0)
 
 
 class SegmentationLosses:
@@ -11,11 +84,20 @@ class SegmentationLosses:
         ignore_index=255,
         cuda=False,
     ):
+        # cuda is accepted only for backward compatibility, the criteria
+        # follow the device of the logits
         self.ignore_index = ignore_index
-        self.weight = weight
         self.size_average = size_average
         self.batch_average = batch_average
-        self.cuda = cuda
+
+        reduction = "mean" if size_average else "sum"
+        self._ce = nn.CrossEntropyLoss(
+            weight=weight, ignore_index=ignore_index, reduction=reduction
+        )
+
+    @property
+    def weight(self):
+        return self._ce.weight
 
     def build_loss(self, mode="ce"):
         """Choices: ['ce' or 'focal']"""
@@ -28,17 +110,18 @@ class SegmentationLosses:
         else:
             raise NotImplementedError
 
+    def _weight_to(self, device):
+        # the class weight is the only state the criteria carry; move it to
+        # the device of the logits once instead of calling .cuda() per step
+        weight = self._ce.weight
+        if weight is not None and weight.device != device:
+            self._ce.weight = weight.to(device)
+        return self._ce.weight
+
     def CrossEntropyLoss(self, logit, target):
         n, _, h, w = logit.size()
-        criterion = nn.CrossEntropyLoss(
-            weight=self.weight,
-            ignore_index=self.ignore_index,
-            size_average=self.size_average,
-        )
-        if self.cuda:
-            criterion = criterion.cuda()
-
-        loss = criterion(logit, target.long())
+        self._weight_to(logit.device)
+        loss = self._ce(logit, target.long())
 
         if self.batch_average:
             loss /= n
@@ -46,13 +129,10 @@ class SegmentationLosses:
         return loss
 
     def CrossEntropyLossFinetune(self, logit, target):
-        criterion = nn.CrossEntropyLoss(
-            ignore_index=self.ignore_index, size_average=self.size_average
-        )
-        if self.cuda:
-            criterion = criterion.cuda()
-
-        loss = criterion(logit, target.long())
+        target = target.long()
+        loss = _ce_core(logit, target, self.ignore_index).sum()
+        if self.size_average:
+            loss /= (target != self.ignore_index).sum()
 
         if self.batch_average:
             loss /= logit.shape[0]
@@ -61,19 +141,20 @@ class SegmentationLosses:
 
     def FocalLoss(self, logit, target, gamma=2, alpha=0.5):
         n, _, h, w = logit.size()
-        criterion = nn.CrossEntropyLoss(
-            weight=self.weight,
-            ignore_index=self.ignore_index,
-            size_average=self.size_average,
-        )
-        if self.cuda:
-            criterion = criterion.cuda()
+        target = target.long()
+        loss = _focal_core(logit, target, self.ignore_index, gamma, alpha)
 
-        logpt = -criterion(logit, target.long())
-        pt = torch.exp(logpt)
-        if alpha is not None:
-            logpt *= alpha
-        loss = -((1 - pt) ** gamma) * logpt
+        valid = target != self.ignore_index
+        weight = self._weight_to(logit.device)
+        if weight is not None:
+            pixel_weight = weight[target.masked_fill(~valid, 0)] * valid
+            loss = (loss * pixel_weight).sum()
+            denom = pixel_weight.sum()
+        else:
+            loss = loss.sum()
+            denom = valid.sum()
+        if self.size_average:
+            loss /= denom
 
         if self.batch_average:
             loss /= n
@@ -85,15 +166,17 @@ class GMMNLoss:
     def __init__(self, sigma=[2, 5, 10, 20, 40, 80], cuda=False):
         self.sigma = sigma
         self.cuda = cuda
+        self.sigma_t = torch.tensor(sigma, dtype=torch.float).view(-1, 1, 1)
+        self._s_cache = {}
 
     def build_loss(self):
         return self.moment_loss
 
-    def get_scale_matrix(self, M, N):
-        s1 = torch.ones((N, 1)) * 1.0 / N
-        s2 = torch.ones((M, 1)) * -1.0 / M
-        if self.cuda:
-            s1, s2 = s1.cuda(), s2.cuda()
+    def get_scale_matrix(self, M, N, device=None):
+        if device is None:
+            device = "cuda" if self.cuda else "cpu"
+        s1 = torch.ones((N, 1), device=device) * 1.0 / N
+        s2 = torch.ones((M, 1), device=device) * -1.0 / M
         return torch.cat((s1, s2), 0)
 
     def moment_loss(self, gen_samples, x):
@@ -103,13 +186,76 @@ class GMMNLoss:
         exp = XX - 0.5 * X2 - 0.5 * X2.t()
         M = gen_samples.size()[0]
         N = x.size()[0]
-        s = self.get_scale_matrix(M, N)
-        S = torch.matmul(s, s.t())
+        # the scale matrix only depends on the sample counts, which are fixed
+        # by batch_size_generator during training
+        key = (M, N, x.device)
+        S = self._s_cache.get(key)
+        if S is None:
+            s = self.get_scale_matrix(M, N, device=x.device)
+            S = torch.matmul(s, s.t())
+            self._s_cache[key] = S
 
-        loss = 0
-        for v in self.sigma:
-            kernel_val = torch.exp(exp / v)
-            loss += torch.sum(S * kernel_val)
+        # match device and dtype of the samples, like the old scalar divide
+        if self.sigma_t.device != X.device or self.sigma_t.dtype != X.dtype:
+            self.sigma_t = self.sigma_t.to(X)
+        # one (len(sigma), M + N, M + N) kernel stack instead of a loop per sigma
+        kernel_val = torch.exp(exp / self.sigma_t)
+        loss = torch.sum(S * kernel_val)
 
         loss = torch.sqrt(loss)
         return loss
+
+
+if __name__ == "__main__":
+    # equivalence checks against the PyTorch reference losses
+    torch.manual_seed(0)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    n, c, h, w = 2, 21, 9, 11
+    target = torch.randint(0, c, (n, h, w), device=device).float()
+    target[:, :3] = 255
+    # a CPU weight with cuda=True, as passed by the pascal/context scripts
+    class_weight = torch.rand(c) + 0.5
+
+    for weight in (None, class_weight):
+        for size_average in (True, False):
+            logit = torch.randn(n, c, h, w, device=device, requires_grad=True)
+            losses = SegmentationLosses(
+                weight=weight, size_average=size_average, cuda=device == "cuda"
+            )
+            loss = losses.build_loss(mode="focal")(logit, target)
+            (grad,) = torch.autograd.grad(loss, logit)
+
+            t = target.long()
+            ce = F.cross_entropy(logit, t, ignore_index=255, reduction="none")
+            pt = torch.exp(-ce)
+            ref = 0.5 * (1 - pt) ** 2 * ce
+            valid = t != 255
+            pixel_weight = valid.float()
+            if weight is not None:
+                pixel_weight = weight.to(device)[t.masked_fill(~valid, 0)] * valid
+            ref = (ref * pixel_weight).sum()
+            if size_average:
+                ref = ref / pixel_weight.sum()
+            ref = ref / n
+            (ref_grad,) = torch.autograd.grad(ref, logit)
+
+            assert torch.allclose(loss, ref, atol=1e-6), ("focal", weight, size_average)
+            assert torch.allclose(grad, ref_grad, atol=1e-6)
+    print("focal loss matches reference")
+
+    for size_average in (True, False):
+        logit = torch.randn(n, c, h, w, device=device, requires_grad=True)
+        losses = SegmentationLosses(size_average=size_average)
+        loss = losses.build_loss(mode="ce_finetune")(logit, target)
+        (grad,) = torch.autograd.grad(loss, logit)
+
+        reduction = "mean" if size_average else "sum"
+        ref = F.cross_entropy(
+            logit, target.long(), ignore_index=255, reduction=reduction
+        )
+        ref = ref / n
+        (ref_grad,) = torch.autograd.grad(ref, logit)
+
+        assert torch.allclose(loss, ref, atol=1e-6), ("ce_finetune", size_average)
+        assert torch.allclose(grad, ref_grad, atol=1e-6)
+    print("finetune cross-entropy matches reference")
@@ -5,15 +5,17 @@ class GMMNLoss:
     def __init__(self, sigma=[2, 5, 10, 20, 40, 80], cuda=False):
         self.sigma = sigma
         self.cuda = cuda
+        self.sigma_t = torch.tensor(sigma, dtype=torch.float).view(-1, 1, 1)
+        self._s_cache = {}
 
     def build_loss(self):
         return self.moment_loss
 
-    def get_scale_matrix(self, M, N):
-        s1 = torch.ones((N, 1)) * 1.0 / N
-        s2 = torch.ones((M, 1)) * -1.0 / M
-        if self.cuda:
-            s1, s2 = s1.cuda(), s2.cuda()
+    def get_scale_matrix(self, M, N, device=None):
+        if device is None:
+            device = "cuda" if self.cuda else "cpu"
+        s1 = torch.ones((N, 1), device=device) * 1.0 / N
+        s2 = torch.ones((M, 1), device=device) * -1.0 / M
         return torch.cat((s1, s2), 0)
 
     def moment_loss(self, gen_samples, x):
@@ -23,13 +25,21 @@ class GMMNLoss:
         exp = XX - 0.5 * X2 - 0.5 * X2.t()
         M = gen_samples.size()[0]
         N = x.size()[0]
-        s = self.get_scale_matrix(M, N)
-        S = torch.matmul(s, s.t())
+        # the scale matrix only depends on the sample counts, which are fixed
+        # by batch_size_generator during training
+        key = (M, N, x.device)
+        S = self._s_cache.get(key)
+        if S is None:
+            s = self.get_scale_matrix(M, N, device=x.device)
+            S = torch.matmul(s, s.t())
+            self._s_cache[key] = S
 
-        loss = 0
-        for v in self.sigma:
-            kernel_val = torch.exp(exp / v)
-            loss += torch.sum(S * kernel_val)
+        # match device and dtype of the samples, like the old scalar divide
+        if self.sigma_t.device != X.device or self.sigma_t.dtype != X.dtype:
+            self.sigma_t = self.sigma_t.to(X)
+        # one (len(sigma), M + N, M + N) kernel stack instead of a loop per sigma
+        kernel_val = torch.exp(exp / self.sigma_t)
+        loss = torch.sum(S * kernel_val)
 
         loss = torch.sqrt(loss)
         return loss